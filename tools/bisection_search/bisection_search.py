@@ -241,6 +241,7 @@ class ExternalScriptOutputCheck(IOutputCheck):
     with NamedTemporaryFile(mode='w', delete=False) as temp_file:
       temp_file.write(output)
       temp_file.flush()
+      self._logfile.flush()
       ret_code = call(
           [self._script_path, self._expected_output_path, temp_file.name],
           stdout=self._logfile, stderr=self._logfile, universal_newlines=True)
@@ -422,6 +423,7 @@ def main():
   except Exception as e:
     print('Error occurred.\nLogfile: {0}'.format(test_env.logfile.name))
     test_env.logfile.write('Exception: {0}\n'.format(e))
+    test_env.logfile.flush()
     raise
 
   # Report results
@@ -432,6 +434,7 @@ def main():
         method))
   else:
     print('Faulty method and pass: {0}, {1}.'.format(method, opt_pass))
+  test_env.logfile.flush()
   print('Logfile: {0}'.format(test_env.logfile.name))
   sys.exit(0)
 
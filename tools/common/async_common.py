@@ -0,0 +1,127 @@
+#!/usr/bin/env python3.5
+#
+# Copyright (C) 2016 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Module containing asyncio variants of common test environment logic.
+
+Requires Python 3.5. Kept apart from common.py, so that tools which do not run
+commands concurrently keep working with python3.4.
+"""
+
+import asyncio
+import io
+import os
+import signal
+
+from subprocess import CalledProcessError
+from subprocess import PIPE
+
+from common.common import HostTestEnv
+from common.common import LogCmdOutput
+from common.common import LogSeverity
+from common.common import RetCode
+
+
+def _DecodeOutput(data):
+  """Decodes command output the same way Popen does in text mode."""
+  return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+async def _RunCommandForOutputAndLogAsync(cmd, env, logfile, timeout=60):
+  """Asynchronously runs command and logs its output.
+
+  Asyncio counterpart of common._RunCommandForOutputAndLog. Output is logged
+  once the command finishes, stdout followed by stderr.
+
+  Args:
+    cmd: list of strings, command to run.
+    env: shell environment to run the command with.
+    logfile: file handle to logfile.
+    timeout: int, timeout in seconds.
+
+  Returns:
+    tuple (string, string, RetCode) stdout output, stderr output, normalized
+      return code.
+  """
+  proc = await asyncio.create_subprocess_exec(
+      *cmd, stdout=PIPE, stderr=PIPE, env=env, start_new_session=True)
+  # Read output in separate tasks, so that it is not lost if waiting for the
+  # process times out.
+  stdout_task = asyncio.ensure_future(proc.stdout.read())
+  stderr_task = asyncio.ensure_future(proc.stderr.read())
+  try:
+    await asyncio.wait_for(proc.wait(), timeout)
+    if proc.returncode == 0:
+      retcode = RetCode.SUCCESS
+    else:
+      retcode = RetCode.ERROR
+  except asyncio.TimeoutError:
+    os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+    await proc.wait()
+    retcode = RetCode.TIMEOUT
+  output = _DecodeOutput(await stdout_task)
+  stderr_output = _DecodeOutput(await stderr_task)
+  LogCmdOutput(logfile, cmd, output + stderr_output, retcode)
+  return (output, stderr_output, retcode)
+
+
+async def RunCommandAsync(test_env, cmd, log_severity=LogSeverity.ERROR):
+  """Runs command in test environment without blocking the event loop.
+
+  AsyncHostTestEnv runs the command natively in the event loop. Other
+  environments run their blocking RunCommand in the event loop's default
+  executor. Commands run in one environment share its dex cache, independent
+  commands that run concurrently should use separate environments.
+
+  Args:
+    test_env: ITestEnv, environment to run the command in.
+    cmd: list of strings, command to run.
+    log_severity: LogSeverity, minimum severity of logs included in output.
+  Returns:
+    tuple (string, int) output, return code.
+  """
+  if isinstance(test_env, AsyncHostTestEnv):
+    return await test_env.RunCommandAsync(cmd, log_severity)
+  loop = asyncio.get_event_loop()
+  return await loop.run_in_executor(None, test_env.RunCommand, cmd,
+                                    log_severity)
+
+
+class AsyncHostTestEnv(HostTestEnv):
+  """Host test environment able to run commands from asyncio coroutines.
+
+  For methods documentation see base classes.
+  """
+
+  async def RunCommandAsync(self, cmd, log_severity=LogSeverity.ERROR):
+    """Asyncio counterpart of RunCommand. See ITestEnv.RunCommand."""
+    await self._EmptyDexCacheAsync()
+    (output, err_output, retcode) = await _RunCommandForOutputAndLogAsync(
+        cmd, self.ShellEnv(log_severity), self.logfile, self.timeout)
+    output += err_output
+    self.logfile.flush()
+    return (output, retcode)
+
+  async def _EmptyDexCacheAsync(self):
+    """Asyncio counterpart of _EmptyDexCache.
+
+    Raises:
+      CalledProcessError: Emptying dex cache failed.
+    """
+    self.logfile.flush()
+    proc = await asyncio.create_subprocess_exec(
+        *self.empty_dex_cache_cmd, stdout=self.logfile, stderr=self.logfile)
+    if await proc.wait() != 0:
+      raise CalledProcessError(proc.returncode, self.empty_dex_cache_cmd)
@@ -17,17 +17,25 @@
 """Module containing common logic from python testing tools."""
 
 import abc
+import functools
+import hashlib
+import itertools
 import os
+import re
+import select
 import signal
 import shlex
 import shutil
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from enum import unique
 
 from subprocess import DEVNULL
 from subprocess import check_call
+from subprocess import check_output
 from subprocess import PIPE
 from subprocess import Popen
 from subprocess import STDOUT
@@ -39,9 +47,43 @@ from tempfile import NamedTemporaryFile
 # Temporary directory path on device.
 DEVICE_TMP_PATH = '/data/local/tmp'
 
+# Host temporary directory paths. TMPFS_TMP_PATH is used for host test
+# environments when BISECTION_TMPFS=1 and it is writable.
+HOST_TMP_PATH = '/tmp/'
+TMPFS_TMP_PATH = '/dev/shm/'
+
+# Size of logfile write buffer in bytes. Logfile has to be flushed before its
+# file descriptor is handed to a subprocess. It is also flushed after every
+# RunCommand, so that little of the log is lost if the process gets killed.
+LOGFILE_BUFFER_SIZE = 1 << 20
+
 # Architectures supported in dalvik cache.
 DALVIK_CACHE_ARCHS = ['arm', 'arm64', 'x86', 'x86_64']
 
+# Maps ABIs reported by device to dalvik cache architectures.
+ABI_TO_DALVIK_CACHE_ARCH = {
+    'armeabi': 'arm',
+    'armeabi-v7a': 'arm',
+    'arm64-v8a': 'arm64',
+    'x86': 'x86',
+    'x86_64': 'x86_64',
+}
+
+# Marker printed by persistent adb shell after each command, followed by the
+# command's exit status. It is printed in two halves so that a shell echoing its
+# input does not produce the marker.
+ADB_SHELL_END_MARKER = '__BISECTION_SHELL_END__'
+ADB_SHELL_END_MARKER_SPLIT = 11
+
+# Seconds to wait for the persistent adb shell to exit before killing it.
+ADB_SHELL_EXIT_TIMEOUT = 5
+
+# Oldest adb version accepting multiple sources in a single push.
+ADB_MULTI_PUSH_MIN_VERSION = (1, 0, 36)
+
+# Maximum number of concurrent adb pushes when adb lacks multi-source push.
+ADB_MAX_CONCURRENT_PUSHES = 4
+
 
 @unique
 class RetCode(Enum):
@@ -124,17 +166,52 @@ def GetJackClassPath():
        + libdir + '/core-oj-hostdex_intermediates/classes.jack'
 
 
-def _DexArchCachePaths(android_data_path):
+def _HostEnvTmpPath():
+  """Returns directory to create host test environments in.
+
+  dex2oat writes and deletes compiled files on every run, so a RAM backed
+  directory avoids disk I/O. It is opt in via BISECTION_TMPFS=1.
+
+  Returns:
+    string, path to directory.
+  """
+  if (os.environ.get('BISECTION_TMPFS') == '1' and
+      os.access(TMPFS_TMP_PATH, os.W_OK)):
+    return TMPFS_TMP_PATH
+  return HOST_TMP_PATH
+
+
+@functools.lru_cache(maxsize=2)
+def _HostArtPaths(x64):
+  """Returns paths to host ART installation.
+
+  Args:
+    x64: boolean, whether to return paths for x64 mode.
+
+  Returns:
+    tuple (string, string, string) android root, library path and binaries
+      path.
+
+  Raises:
+    FatalError: ANDROID_HOST_OUT is not set.
+  """
+  android_root = GetEnvVariableOrError('ANDROID_HOST_OUT')
+  lib = 'lib64' if x64 else 'lib'
+  return (android_root, android_root + '/' + lib, android_root + '/bin')
+
+
+def _DexArchCachePaths(android_data_path, archs=DALVIK_CACHE_ARCHS):
   """Returns paths to architecture specific caches.
 
   Args:
     android_data_path: string, path dalvik-cache resides in.
+    archs: list of strings, architectures to return caches for.
 
   Returns:
-    Iterable paths to architecture specific caches.
+    tuple of strings, paths to architecture specific caches.
   """
-  return ('{0}/dalvik-cache/{1}'.format(android_data_path, arch)
-          for arch in DALVIK_CACHE_ARCHS)
+  return tuple('{0}/dalvik-cache/{1}'.format(android_data_path, arch)
+               for arch in archs)
 
 
 def RunCommandForOutput(cmd, env, stdout, stderr, timeout=60):
@@ -168,7 +245,62 @@ def RunCommandForOutput(cmd, env, stdout, stderr, timeout=60):
   return (output, stderr_output, retcode)
 
 
-def _LogCmdOutput(logfile, cmd, output, retcode):
+def _RunCommandForOutputAndLog(cmd, env, logfile, timeout=60):
+  """Runs command streaming its output to logfile as it arrives.
+
+  Output is logged in the same format as LogCmdOutput, with stdout and stderr
+  lines interleaved in arrival order.
+
+  Args:
+    cmd: list of strings, command to run.
+    env: shell environment to run the command with.
+    logfile: file handle to logfile.
+    timeout: int, timeout in seconds.
+
+  Returns:
+    tuple (string, string, RetCode) stdout output, stderr output, normalized
+      return code.
+  """
+  logfile.write('Command:\n{0}\n'.format(CommandListToCommandString(cmd)))
+  # close_fds is left at its default (True) and start_new_session is set. The
+  # former stops logfile and adb shell pipes from leaking into the child, the
+  # latter is needed to kill the whole process group on timeout. On Linux with
+  # CPython 3.10+ the child is then launched with vfork(), so the parent's
+  # memory is not copied. Older Pythons use plain fork().
+  proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env,
+               universal_newlines=True, start_new_session=True)
+  log_lock = threading.Lock()
+
+  def Drain(stream, lines):
+    for line in stream:
+      lines.append(line)
+      with log_lock:
+        logfile.write(line)
+    stream.close()
+
+  output = []
+  stderr_output = []
+  readers = [threading.Thread(target=Drain, args=(proc.stdout, output)),
+             threading.Thread(target=Drain, args=(proc.stderr, stderr_output))]
+  for reader in readers:
+    reader.start()
+  try:
+    proc.wait(timeout=timeout)
+    if proc.returncode == 0:
+      retcode = RetCode.SUCCESS
+    else:
+      retcode = RetCode.ERROR
+  except TimeoutExpired:
+    os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+    proc.wait()
+    retcode = RetCode.TIMEOUT
+  for reader in readers:
+    reader.join()
+  logfile.write('\nReturn code: {0}\n'.format(retcode))
+  return (''.join(output), ''.join(stderr_output), retcode)
+
+
+def LogCmdOutput(logfile, cmd, output, retcode):
   """Logs output of a command.
 
   Args:
@@ -208,10 +340,18 @@ def RunCommand(cmd, out, err, timeout=5):
   return retcode
 
 
+def _JoinLines(lines):
+  """Joins lines into a single string, terminating each with a newline."""
+  if not lines:
+    return ''
+  return '\n'.join(lines) + '\n'
+
+
 def CommandListToCommandString(cmd):
   """Converts shell command represented as list of strings to a single string.
 
-  Each element of the list is wrapped in double quotes.
+  Each element of the list is shell-escaped, so the result can be passed as a
+  single argument to a remote shell and parses back to the same list.
 
   Args:
     cmd: list of strings, shell command.
@@ -278,8 +418,9 @@ class ITestEnv(object):
 class HostTestEnv(ITestEnv):
   """Host test environment. Concrete implementation of ITestEnv.
 
-  Maintains a test directory in /tmp/. Runs commands on the host in modified
-  shell environment. Mimics art script behavior.
+  Maintains a test directory in /tmp/ (or /dev/shm/, see _HostEnvTmpPath).
+  Runs commands on the host in modified shell environment. Mimics art script
+  behavior.
 
   For methods documentation see base class.
   """
@@ -297,18 +438,18 @@ class HostTestEnv(ITestEnv):
     """
     self._cleanup = cleanup
     self._timeout = timeout
-    self._env_path = mkdtemp(dir='/tmp/', prefix=directory_prefix)
+    self._env_path = mkdtemp(dir=_HostEnvTmpPath(), prefix=directory_prefix)
+    self._arch_cache_paths = _DexArchCachePaths(self._env_path)
+    self._empty_dex_cache_cmd = (['find'] + list(self._arch_cache_paths) +
+                                 ['-maxdepth', '1', '-type', 'f', '-delete'])
     if logfile_path is None:
-      self._logfile = open('{0}/log'.format(self._env_path), 'w+')
+      self._logfile = open('{0}/log'.format(self._env_path), 'w+',
+                           buffering=LOGFILE_BUFFER_SIZE)
     else:
-      self._logfile = open(logfile_path, 'w+')
-    os.mkdir('{0}/dalvik-cache'.format(self._env_path))
-    for arch_cache_path in _DexArchCachePaths(self._env_path):
-      os.mkdir(arch_cache_path)
-    lib = 'lib64' if x64 else 'lib'
-    android_root = GetEnvVariableOrError('ANDROID_HOST_OUT')
-    library_path = android_root + '/' + lib
-    path = android_root + '/bin'
+      self._logfile = open(logfile_path, 'w+', buffering=LOGFILE_BUFFER_SIZE)
+    for arch_cache_path in self._arch_cache_paths:
+      os.makedirs(arch_cache_path)
+    (android_root, library_path, path) = _HostArtPaths(x64)
     self._shell_env = os.environ.copy()
     self._shell_env['ANDROID_DATA'] = self._env_path
     self._shell_env['ANDROID_ROOT'] = android_root
@@ -317,6 +458,8 @@ class HostTestEnv(ITestEnv):
     self._shell_env['PATH'] = (path + ':' + self._shell_env['PATH'])
     # Using dlopen requires load bias on the host.
     self._shell_env['LD_USE_LOAD_BIAS'] = '1'
+    # Shell environments with ANDROID_LOG_TAGS set, keyed by LogSeverity.
+    self._log_shell_envs = {}
 
   def __del__(self):
     if self._cleanup:
@@ -331,36 +474,58 @@ class HostTestEnv(ITestEnv):
 
   def WriteLines(self, file_path, lines):
     with open(file_path, 'w') as f:
-      f.writelines('{0}\n'.format(line) for line in lines)
+      f.write(_JoinLines(lines))
     return
 
   def RunCommand(self, cmd, log_severity=LogSeverity.ERROR):
     self._EmptyDexCache()
-    env = self._shell_env.copy()
-    env.update({'ANDROID_LOG_TAGS':'*:' + log_severity.symbol.lower()})
-    (output, err_output, retcode) = RunCommandForOutput(
-        cmd, env, PIPE, PIPE, self._timeout)
+    (output, err_output, retcode) = _RunCommandForOutputAndLog(
+        cmd, self.ShellEnv(log_severity), self._logfile, self._timeout)
     # We append err_output to output to stay consistent with DeviceTestEnv
     # implementation.
     output += err_output
-    _LogCmdOutput(self._logfile, cmd, output, retcode)
+    self._logfile.flush()
     return (output, retcode)
 
   @property
   def logfile(self):
     return self._logfile
 
+  @property
+  def timeout(self):
+    """Gets time in seconds to wait for single test run to finish."""
+    return self._timeout
+
+  @property
+  def empty_dex_cache_cmd(self):
+    """Gets command, list of strings, which empties dex cache."""
+    return self._empty_dex_cache_cmd
+
+  def ShellEnv(self, log_severity):
+    """Returns shell environment with ANDROID_LOG_TAGS set.
+
+    Args:
+      log_severity: LogSeverity, minimum severity of logs.
+
+    Returns:
+      dict, shell environment.
+    """
+    env = self._log_shell_envs.get(log_severity)
+    if env is None:
+      env = self._shell_env.copy()
+      env['ANDROID_LOG_TAGS'] = '*:' + log_severity.symbol.lower()
+      self._log_shell_envs[log_severity] = env
+    return env
+
   def _EmptyDexCache(self):
     """Empties dex cache.
 
-    Iterate over files in architecture specific cache directories and remove
-    them.
+    Removes files in architecture specific cache directories with a single
+    find invocation.
     """
-    for arch_cache_path in _DexArchCachePaths(self._env_path):
-      for file_path in os.listdir(arch_cache_path):
-        file_path = '{0}/{1}'.format(arch_cache_path, file_path)
-        if os.path.isfile(file_path):
-          os.unlink(file_path)
+    self._logfile.flush()
+    check_call(self._empty_dex_cache_cmd, stdout=self._logfile,
+               stderr=self._logfile)
 
 
 class DeviceTestEnv(ITestEnv):
@@ -369,6 +534,10 @@ class DeviceTestEnv(ITestEnv):
   For methods documentation see base class.
   """
 
+  # Limits concurrent adb pushes across all environments, so that parallel
+  # pushes do not overwhelm the adb server.
+  _adb_push_semaphore = threading.BoundedSemaphore(ADB_MAX_CONCURRENT_PUSHES)
+
   def __init__(self, directory_prefix, cleanup=True, logfile_path=None,
                timeout=60, specific_device=None):
     """Constructor.
@@ -383,38 +552,83 @@ class DeviceTestEnv(ITestEnv):
     self._cleanup = cleanup
     self._timeout = timeout
     self._specific_device = specific_device
-    self._host_env_path = mkdtemp(dir='/tmp/', prefix=directory_prefix)
+    self._host_env_path = mkdtemp(dir=HOST_TMP_PATH, prefix=directory_prefix)
     if logfile_path is None:
-      self._logfile = open('{0}/log'.format(self._host_env_path), 'w+')
+      self._logfile = open('{0}/log'.format(self._host_env_path), 'w+',
+                           buffering=LOGFILE_BUFFER_SIZE)
     else:
-      self._logfile = open(logfile_path, 'w+')
+      self._logfile = open(logfile_path, 'w+', buffering=LOGFILE_BUFFER_SIZE)
     self._device_env_path = '{0}/{1}'.format(
         DEVICE_TMP_PATH, os.path.basename(self._host_env_path))
     self._shell_env = os.environ.copy()
-
-    self._AdbMkdir('{0}/dalvik-cache'.format(self._device_env_path))
-    for arch_cache_path in _DexArchCachePaths(self._device_env_path):
-      self._AdbMkdir(arch_cache_path)
+    self._adb_multi_push = None
+    # Used to name files created without an explicit name. Hidden names keep
+    # them apart from names chosen by callers.
+    self._file_counter = itertools.count()
+    # SHA-256 digests of content last written by WriteLines, keyed by device
+    # file path.
+    self._content_digests = {}
+    self._adb_cmd = ['adb']
+    if self._specific_device:
+      self._adb_cmd += ['-s', self._specific_device]
+    self._logcat_cmd = self._adb_cmd + ['logcat', '-v', 'brief', '-s', '-b',
+                                        'main', '-T', '1', 'dex2oat:*',
+                                        'dex2oatd:*']
+    # Prints PID of the shell and execs command. We later retrieve this PID and
+    # use it to filter dex2oat logs, keeping those with matching parent PID.
+    self._device_cmd_prefix = (
+        'echo $$ && ANDROID_DATA={0} ANDROID_LOG_TAGS=*:i exec '.format(
+            shlex.quote(self._device_env_path)))
+    # Long-lived shell used for short housekeeping commands. Avoids paying adb
+    # connection setup on every command.
+    self._adb_shell = Popen(self._adb_cmd + ['shell'], stdin=PIPE, stdout=PIPE,
+                            stderr=STDOUT, env=self._shell_env,
+                            universal_newlines=True)
+    # Output read from the shell but not yet consumed by _AdbShell.
+    self._adb_shell_output = b''
+    # Devices without shell protocol v2 run the shell on a PTY, which echoes
+    # input. Turn echo off, there is no terminal to configure otherwise.
+    self._AdbShell('stty -echo 2>/dev/null; true')
+    self._active_archs = self._ProbeActiveArchs()
+    self._arch_cache_paths = _DexArchCachePaths(self._device_env_path,
+                                                self._active_archs)
+
+    with DeviceOpBatch(self._AdbShell) as batch:
+      batch.Mkdir(self._arch_cache_paths)
 
   def __del__(self):
-    if self._cleanup:
-      shutil.rmtree(self._host_env_path)
-      check_call(shlex.split(
-          'adb shell if [ -d "{0}" ]; then rm -rf "{0}"; fi'
-          .format(self._device_env_path)))
+    # Constructor may have failed before the adb shell was started.
+    adb_shell = getattr(self, '_adb_shell', None)
+    try:
+      if self._cleanup:
+        shutil.rmtree(self._host_env_path)
+        if adb_shell is not None:
+          self._AdbShell('if [ -d {0} ]; then rm -rf {0}; fi'.format(
+              shlex.quote(self._device_env_path)))
+    finally:
+      if adb_shell is not None:
+        self._CloseAdbShell()
 
   def CreateFile(self, name=None):
-    with NamedTemporaryFile(mode='w') as temp_file:
-      self._AdbPush(temp_file.name, self._device_env_path)
-      if name is None:
-        name = os.path.basename(temp_file.name)
-      return '{0}/{1}'.format(self._device_env_path, name)
+    if name is None:
+      name = '.anon{0}'.format(next(self._file_counter))
+    file_path = '{0}/{1}'.format(self._device_env_path, name)
+    with DeviceOpBatch(self._AdbShell) as batch:
+      batch.Truncate(file_path)
+    self._content_digests.pop(file_path, None)
+    return file_path
 
   def WriteLines(self, file_path, lines):
+    content = _JoinLines(lines)
+    digest = hashlib.sha256(content.encode()).digest()
+    # Skip the push if file already holds the same content.
+    if self._content_digests.get(file_path) == digest:
+      return
     with NamedTemporaryFile(mode='w') as temp_file:
-      temp_file.writelines('{0}\n'.format(line) for line in lines)
+      temp_file.write(content)
       temp_file.flush()
       self._AdbPush(temp_file.name, file_path)
+    self._content_digests[file_path] = digest
     return
 
   def _ExtractPid(self, brief_log_line):
@@ -435,20 +649,10 @@ class DeviceTestEnv(ITestEnv):
 
   def RunCommand(self, cmd, log_severity=LogSeverity.ERROR):
     self._EmptyDexCache()
-    env_vars_cmd = 'ANDROID_DATA={0} ANDROID_LOG_TAGS=*:i'.format(
-        self._device_env_path)
-    adb_cmd = ['adb']
-    if self._specific_device:
-      adb_cmd += ['-s', self._specific_device]
-    logcat_cmd = adb_cmd + ['logcat', '-v', 'brief', '-s', '-b', 'main',
-                            '-T', '1', 'dex2oat:*', 'dex2oatd:*']
-    logcat_proc = Popen(logcat_cmd, stdout=PIPE, stderr=STDOUT,
+    logcat_proc = Popen(self._logcat_cmd, stdout=PIPE, stderr=STDOUT,
                         universal_newlines=True)
-    cmd_str = CommandListToCommandString(cmd)
-    # Print PID of the shell and exec command. We later retrieve this PID and
-    # use it to filter dex2oat logs, keeping those with matching parent PID.
-    device_cmd = ('echo $$ && ' + env_vars_cmd + ' exec ' + cmd_str)
-    cmd = adb_cmd + ['shell', device_cmd]
+    device_cmd = self._device_cmd_prefix + CommandListToCommandString(cmd)
+    cmd = self._adb_cmd + ['shell', device_cmd]
     (output, _, retcode) = RunCommandForOutput(cmd, self._shell_env, PIPE,
                                                STDOUT, self._timeout)
     # We need to make sure to only kill logcat once all relevant logs arrive.
@@ -472,7 +676,8 @@ class DeviceTestEnv(ITestEnv):
           if (self._ExtractPid(line) in dex2oat_pids and
               self._ExtractSeverity(line) >= log_severity):
             output += line
-    _LogCmdOutput(self._logfile, cmd, output, retcode)
+    LogCmdOutput(self._logfile, cmd, output, retcode)
+    self._logfile.flush()
     return (output, retcode)
 
   @property
@@ -491,24 +696,232 @@ class DeviceTestEnv(ITestEnv):
       string, classpath valid on device.
     """
     paths = classpath.split(':')
-    device_paths = []
-    for path in paths:
-      device_paths.append('{0}/{1}'.format(
-          self._device_env_path, os.path.basename(path)))
-      self._AdbPush(path, self._device_env_path)
+    device_paths = ['{0}/{1}'.format(self._device_env_path,
+                                     os.path.basename(path))
+                    for path in paths]
+    self._AdbPushMany(paths, self._device_env_path)
     return ':'.join(device_paths)
 
   def _AdbPush(self, what, where):
-    check_call(shlex.split('adb push "{0}" "{1}"'.format(what, where)),
+    # Content of where is no longer known to WriteLines.
+    self._content_digests.pop(where, None)
+    self._logfile.flush()
+    check_call(self._adb_cmd + ['push', what, where],
                stdout=self._logfile, stderr=self._logfile)
 
-  def _AdbMkdir(self, path):
-    check_call(shlex.split('adb shell mkdir "{0}" -p'.format(path)),
-               stdout=self._logfile, stderr=self._logfile)
+  def _AdbPushMany(self, what, where):
+    """Pushes multiple files to a directory on device.
+
+    Uses a single adb invocation if adb supports it, otherwise pushes files
+    concurrently.
+
+    Args:
+      what: list of strings, paths to files on host.
+      where: string, path to directory on device.
+    """
+    for path in what:
+      self._content_digests.pop(
+          '{0}/{1}'.format(where, os.path.basename(path)), None)
+    if self._AdbSupportsMultiPush():
+      self._logfile.flush()
+      check_call(self._adb_cmd + ['push'] + what + [where],
+                 stdout=self._logfile, stderr=self._logfile)
+    else:
+      def Push(path):
+        with self._adb_push_semaphore:
+          self._AdbPush(path, where)
+      with ThreadPoolExecutor(ADB_MAX_CONCURRENT_PUSHES) as executor:
+        list(executor.map(Push, what))
+
+  def _AdbSupportsMultiPush(self):
+    """Checks whether adb accepts multiple sources in a single push.
+
+    Adb version is probed once and the result is cached.
+
+    Returns:
+      boolean, True if adb supports multiple sources.
+    """
+    if self._adb_multi_push is None:
+      self._logfile.flush()
+      output = check_output(['adb', 'version'], stderr=self._logfile,
+                            universal_newlines=True)
+      match = re.search(r'version (\d+)\.(\d+)\.(\d+)', output)
+      self._adb_multi_push = (
+          match is not None and
+          tuple(int(x) for x in match.groups()) >= ADB_MULTI_PUSH_MIN_VERSION)
+    return self._adb_multi_push
+
+  def _AdbShell(self, cmd):
+    """Runs command in the persistent adb shell.
+
+    Command output is written to logfile.
+
+    Args:
+      cmd: string, shell command to run.
+
+    Returns:
+      string, command output.
+
+    Raises:
+      FatalError: Command failed, timed out or adb shell terminated.
+    """
+    if self._adb_shell.poll() is not None:
+      raise FatalError('adb shell terminated unexpectedly.')
+    try:
+      self._adb_shell.stdin.write(
+          "{0}\nprintf '%s%s%d\\n' {1} {2} $?\n".format(
+              cmd, ADB_SHELL_END_MARKER[:ADB_SHELL_END_MARKER_SPLIT],
+              ADB_SHELL_END_MARKER[ADB_SHELL_END_MARKER_SPLIT:]))
+      self._adb_shell.stdin.flush()
+    except BrokenPipeError:
+      raise FatalError('adb shell terminated unexpectedly.')
+    deadline = time.monotonic() + self._timeout
+    output = ''
+    while True:
+      line = self._ReadAdbShellLine(deadline)
+      if line is None:
+        self._adb_shell.kill()
+        self._adb_shell.wait()
+        raise FatalError('Command {0} timed out on device.'.format(cmd))
+      # Shells running on a PTY terminate lines with '\r\n'.
+      line = line.replace('\r', '')
+      marker_idx = line.rfind(ADB_SHELL_END_MARKER)
+      if marker_idx == -1:
+        output += line
+        continue
+      output += line[:marker_idx]
+      self._logfile.write(output)
+      retcode = int(line[marker_idx + len(ADB_SHELL_END_MARKER):])
+      if retcode != 0:
+        raise FatalError('Command {0} failed on device with {1}.'.format(
+            cmd, retcode))
+      return output
+
+  def _ReadAdbShellLine(self, deadline):
+    """Reads a line of persistent adb shell output.
+
+    Reads the pipe directly with select, bypassing stdout buffering, so that
+    reading can time out.
+
+    Args:
+      deadline: float, time.monotonic() value after which reading times out.
+
+    Returns:
+      string, line including its terminator, None if reading timed out.
+
+    Raises:
+      FatalError: adb shell terminated.
+    """
+    fd = self._adb_shell.stdout.fileno()
+    while b'\n' not in self._adb_shell_output:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+        return None
+      data = os.read(fd, 4096)
+      if not data:
+        raise FatalError('adb shell terminated unexpectedly.')
+      self._adb_shell_output += data
+    (line, _, self._adb_shell_output) = self._adb_shell_output.partition(b'\n')
+    return line.decode(errors='replace') + '\n'
+
+  def _CloseAdbShell(self):
+    """Terminates the persistent adb shell.
+
+    adb without shell protocol v2 does not forward end of input to the device,
+    so the shell is asked to exit explicitly and killed if it does not.
+    """
+    try:
+      self._adb_shell.stdin.write('exit\n')
+      self._adb_shell.stdin.flush()
+    except BrokenPipeError:
+      pass
+    try:
+      self._adb_shell.stdin.close()
+    except BrokenPipeError:
+      pass
+    try:
+      self._adb_shell.wait(timeout=ADB_SHELL_EXIT_TIMEOUT)
+    except TimeoutExpired:
+      self._adb_shell.kill()
+      self._adb_shell.wait()
+
+  def _ProbeActiveArchs(self):
+    """Finds dalvik cache architectures supported by device.
+
+    Returns:
+      list of strings, architectures from DALVIK_CACHE_ARCHS matching ABIs
+      reported by device. All of DALVIK_CACHE_ARCHS if device reports none.
+    """
+    # Split on whitespace as well, so that input echoed by the shell does not
+    # get glued to reported ABIs. Echoed words are not ABIs and get ignored.
+    abis = re.split(r'[,\s]+', self._AdbShell('getprop ro.product.cpu.abilist'))
+    device_archs = set(ABI_TO_DALVIK_CACHE_ARCH.get(abi) for abi in abis)
+    active_archs = [arch for arch in DALVIK_CACHE_ARCHS if arch in device_archs]
+    return active_archs or DALVIK_CACHE_ARCHS
 
   def _EmptyDexCache(self):
     """Empties dex cache."""
-    for arch_cache_path in _DexArchCachePaths(self._device_env_path):
-      cmd = 'adb shell if [ -d "{0}" ]; then rm -f "{0}"/*; fi'.format(
-          arch_cache_path)
-      check_call(shlex.split(cmd), stdout=self._logfile, stderr=self._logfile)
+    with DeviceOpBatch(self._AdbShell) as batch:
+      batch.RemoveFiles(self._arch_cache_paths)
+
+
+class DeviceOpBatch(object):
+  """Batch of file system operations on device.
+
+  Operations are recorded and run as a single device shell command when the
+  batch is flushed. Operations run in order and execution stops at the first
+  failing one.
+
+  Can be used as a context manager, the batch is flushed on exit unless an
+  exception was raised.
+  """
+
+  def __init__(self, run_shell_cmd):
+    """Constructor.
+
+    Args:
+      run_shell_cmd: function taking a shell command string, runs it on device
+        and raises FatalError if it fails.
+    """
+    self._run_shell_cmd = run_shell_cmd
+    self._cmds = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.Flush()
+
+  def Mkdir(self, paths):
+    """Creates directories, including missing parents.
+
+    Args:
+      paths: iterable of strings, paths to directories.
+    """
+    self._cmds.append('mkdir -p {0}'.format(CommandListToCommandString(paths)))
+
+  def RemoveFiles(self, paths):
+    """Removes all files in directories.
+
+    Args:
+      paths: iterable of strings, paths to directories.
+    """
+    self._cmds.append('rm -f {0}'.format(
+        ' '.join(shlex.quote(path) + '/*' for path in paths)))
+
+  def Truncate(self, path):
+    """Creates empty file or truncates existing one."""
+    self._cmds.append(': > {0}'.format(shlex.quote(path)))
+
+  def Flush(self):
+    """Runs recorded operations and clears the batch.
+
+    Raises:
+      FatalError: An operation failed.
+    """
+    if not self._cmds:
+      return
+    cmd = ' && '.join(self._cmds)
+    self._cmds = []
+    self._run_shell_cmd(cmd)